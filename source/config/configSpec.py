@@ -38,6 +38,10 @@ schemaVersion = integer(min=0, default={latestSchemaVersion})
 	outputDevice = string(default=default)
 	autoLanguageSwitching = boolean(default=true)
 	autoDialectSwitching = boolean(default=false)
+	# Leading and trailing SAPI5 audio with peak samples below this level is trimmed, 0 disables trimming.
+	silenceTrimThreshold = integer(default=200,min=0,max=32767)
+	# The most leading and trailing silence (in ms) trimmed from SAPI5 speech.
+	silenceTrimMs = integer(default=200,min=0,max=2000)
 
 	[[__many__]]
 		capPitchChange = integer(default=30,min=-100,max=100)
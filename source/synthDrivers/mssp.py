@@ -8,6 +8,7 @@ from .sapi5 import SynthDriver
 
 class SynthDriver(SynthDriver):
 	COM_CLASS = "speech.SPVoice"
+	CUSTOM_STREAM_COM_CLASS = "speech.SpCustomStream"
 
 	name="mssp"
 	description="Microsoft Speech Platform"
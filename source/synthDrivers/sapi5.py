@@ -5,15 +5,16 @@
 # See the file COPYING for more details.
 
 from enum import IntEnum
+import audioop
 import locale
-from collections import OrderedDict
-import os
-from ctypes import c_long, WINFUNCTYPE, windll
+import re
+from typing import Dict, Optional
+from ctypes import POINTER, byref, c_ulong, c_wchar_p, cast, string_at, windll
 import comtypes.client
-from comtypes import COMError
+from comtypes import COMError, COMObject, IUnknown, hresult
 import winreg
-import audioDucking
-import NVDAHelper
+from comInterfaces.SpeechLib import SPEVENT, ISpEventSource, ISpNotifySink, ISpNotifySource
+from objidl import _LARGE_INTEGER, IStream
 from synthDriverHandler import SynthDriver, VoiceInfo, synthIndexReached, synthDoneSpeaking
 import config
 import nvwave
@@ -33,12 +34,9 @@ from speech.commands import (
 )
 
 
-class SPAudioState(IntEnum):
-	# https://docs.microsoft.com/en-us/previous-versions/windows/desktop/ms720596(v=vs.85)
-	CLOSED = 0
-	STOP = 1
-	PAUSE = 2
-	RUN = 3
+class SpeechAudioFormatType(IntEnum):
+	# https://docs.microsoft.com/en-us/previous-versions/windows/desktop/ms720595(v=vs.85)
+	SAFT22kHz16BitMono = 22
 
 
 class SpeechVoiceSpeakFlags(IntEnum):
@@ -50,105 +48,376 @@ class SpeechVoiceSpeakFlags(IntEnum):
 
 class SpeechVoiceEvents(IntEnum):
 	# https://msdn.microsoft.com/en-us/previous-versions/windows/desktop/ms720886(v=vs.85)
+	StartInputStream = 2
 	EndInputStream = 4
 	Bookmark = 16
 
 
-class FunctionHooker(object):
-	def __init__(
-		self,
-		targetDll: str,
-		importDll: str,
-		funcName: str,
-		newFunction # result of ctypes.WINFUNCTYPE
-	):
-		# dllImportTableHooks_hookSingle expects byte strings.
-		try:
-			self._hook=NVDAHelper.localLib.dllImportTableHooks_hookSingle(
-				targetDll.encode("mbcs"),
-				importDll.encode("mbcs"),
-				funcName.encode("mbcs"),
-				newFunction
-			)
-		except UnicodeEncodeError:
-			log.error("Error encoding FunctionHooker input parameters", exc_info=True)
-			self._hook = None
-		if self._hook:
-			log.debug(f"Hooked {funcName}")
+class SPEventEnum(IntEnum):
+	# https://docs.microsoft.com/en-us/previous-versions/windows/desktop/ee431846(v=vs.85)
+	START_INPUT_STREAM = 1
+	END_INPUT_STREAM = 2
+	TTS_BOOKMARK = 4
+
+
+class SPEventLParamType(IntEnum):
+	# https://docs.microsoft.com/en-us/previous-versions/windows/desktop/ee431848(v=vs.85)
+	UNDEFINED = 0
+	TOKEN = 1
+	OBJECT = 2
+	POINTER = 3
+	STRING = 4
+
+
+class STREAM_SEEK(IntEnum):
+	# https://docs.microsoft.com/en-us/windows/win32/api/objidl/ne-objidl-stream_seek
+	SET = 0
+	CUR = 1
+	END = 2
+
+
+#: Slots for the XML tags tracked by L{SynthDriver.speak}, in the order they are nested.
+_TAG_SLOTS = (_PITCH_TAG, _SPELL_TAG, _VOLUME_TAG, _RATE_TAG) = range(4)
+_TAG_COUNT = len(_TAG_SLOTS)
+#: Escapes the characters in text which SAPI would otherwise treat as markup.
+_XML_ESCAPE = str.maketrans({"<": "&lt;", "&": "&amp;", ">": "&gt;"})
+
+#: Escapes the characters which can't appear in a double quoted XML attribute value.
+_XML_ATTR_ESCAPE = str.maketrans({"<": "&lt;", "&": "&amp;", '"': "&quot;"})
+
+
+def _escapeXml(text: str) -> str:
+	"""Escapes text for SAPI's XML, without copying it if there is nothing to escape.
+	Most text contains no markup characters, in which case the checks are much cheaper than translating.
+	"""
+	if "<" in text or "&" in text or ">" in text:
+		return text.translate(_XML_ESCAPE)
+	return text
+
+
+def _makeIpaToSapiTrans(ipaToSapi: Dict[str, str], stress: str) -> Dict[int, str]:
+	"""Builds a str.translate table which converts IPA characters to space terminated SAPI phonemes.
+	@param ipaToSapi: Maps IPA characters to SAPI phonemes.
+	@param stress: The IPA primary stress mark, which is translated to SAPI's "1".
+	"""
+	return str.maketrans({
+		**{ipaChar: sapi + " " for ipaChar, sapi in ipaToSapi.items()},
+		stress: "1 ",
+	})
+
+
+class _SpeakState:
+	"""The markup being built by L{SynthDriver.speak}, shared with its command handlers."""
+
+	__slots__ = (
+		"textList",
+		"openTagFrags",
+		"closeTagFrags",
+		"openedTagsClose",
+		"tagsChanged",
+		"pitch",
+		"rate",
+		"volume",
+	)
+
+	def __init__(self, pitch: int, rate: int, volume: int):
+		self.textList = []
+		# NVDA SpeechCommands are linear, but XML is hierarchical.
+		# Therefore, we track the markup which opens and closes each non-empty tag.
+		# When a tag changes, we close all previously opened tags and open new ones.
+		# Each tag has a fixed slot in these lists; an empty string means the tag isn't used.
+		self.openTagFrags = [""] * _TAG_COUNT
+		self.closeTagFrags = [""] * _TAG_COUNT
+		#: The markup which closes the currently opened tags, innermost first.
+		self.openedTagsClose = ""
+		self.tagsChanged = True
+		self.pitch = pitch
+		self.rate = rate
+		self.volume = volume
+
+
+class SynthDriverAudioStream(COMObject):
+	"""Implements IStream to receive the audio SAPI produces and feed it to the synth's L{nvwave.WavePlayer}.
+	It is wrapped in an SpCustomStream, which provides the wave format,
+	and set as the voice's AudioOutputStream.
+	"""
+
+	_com_interfaces_ = [IStream]
+	#: The length of the blocks in which audio is checked for silence, in milliseconds.
+	SILENCE_BLOCK_MS = 5
+
+	def __init__(self, synthRef: weakref.ReferenceType, channels: int, samplesPerSec: int, bitsPerSample: int):
+		super().__init__()
+		self.synthRef = synthRef
+		#: The number of bytes written so far, reported as the stream position.
+		self._writtenBytes = 0
+		self._sampleWidth = bitsPerSample // 8
+		self._frameSize = channels * self._sampleWidth
+		self._bytesPerMs = samplesPerSec * self._frameSize / 1000
+		self._silenceBlockSize = self._msToBytes(self.SILENCE_BLOCK_MS) or self._frameSize
+		#: Peak sample value below which audio is considered silent, 0 if silence isn't trimmed.
+		self._silenceThreshold = 0
+		#: The most leading silence which is dropped and the most trailing silence which is held back, in bytes.
+		self._maxHeldSilence = 0
+		#: How much more silence may be dropped from the start of the stream, in bytes.
+		#: This is 0 once audible audio has been written.
+		self._leadingSilence = 0
+		#: Trailing silence which has been held back,
+		#: either to be played before further audio or dropped when the stream ends.
+		self._heldSilence = b""
+		#: The bytes of an incomplete frame at the end of the last write, completed by the next write.
+		self._partialFrame = b""
+		#: The audio of the last write, held back so that a following bookmark can be attached to it.
+		self._lastChunk = b""
+
+	def _msToBytes(self, ms: int) -> int:
+		"""Converts a duration to a number of bytes, rounded down to whole frames."""
+		return int(self._bytesPerMs * ms) // self._frameSize * self._frameSize
+
+	def startStream(self):
+		"""Called when SAPI starts a new stream, i.e. a new utterance."""
+		self._lastChunk = b""
+		self._heldSilence = b""
+		self._partialFrame = b""
+		# Silence is checked with audioop, which treats samples as signed;
+		# only 16 bit PCM is signed.
+		if self._sampleWidth == 2:
+			self._silenceThreshold = config.conf["speech"]["silenceTrimThreshold"]
+		else:
+			self._silenceThreshold = 0
+		self._maxHeldSilence = self._msToBytes(config.conf["speech"]["silenceTrimMs"])
+		self._leadingSilence = self._maxHeldSilence
+
+	def endStream(self):
+		"""Called when SAPI has finished writing a stream. Trailing silence is dropped."""
+		self._heldSilence = b""
+		self._partialFrame = b""
+
+	def feedLastChunk(self, player: nvwave.WavePlayer, onDone=None):
+		"""Feeds the audio held back from the last write to the player.
+		Feeding an index with the audio preceding it, rather than as an empty chunk,
+		avoids blocking until all the audio fed so far has played, which would let the player run dry.
+		@param onDone: Called when the audio has finished playing, e.g. to report a bookmark following it.
+		"""
+		data = self._lastChunk
+		self._lastChunk = b""
+		if data or onDone:
+			player.feed(data, onDone=onDone)
+
+	def discardLastChunk(self):
+		"""Drops the audio held back from the last write, as its speech has been cancelled."""
+		self._lastChunk = b""
+
+	def _trimSilence(self, data: bytes) -> bytes:
+		"""Removes up to L{_maxHeldSilence} of silence from the start of the stream,
+		and holds back up to L{_maxHeldSilence} of silence at the end of the written audio.
+		Limiting the leading silence dropped keeps most of a break at the start of the speech.
+		Silence held back is played if more audible audio follows, otherwise L{endStream} drops it.
+		@param data: The audio written by SAPI.
+		@return: The audio which should be played now.
+		"""
+		threshold = self._silenceThreshold
+		if not threshold:
+			return data
+		# audioop can only check whole samples, so an incomplete frame waits for the rest of its bytes.
+		if self._partialFrame:
+			data = self._partialFrame + data
+		partialSize = len(data) % self._frameSize
+		if partialSize:
+			self._partialFrame = data[-partialSize:]
+			data = data[:-partialSize]
 		else:
-			log.error(f"Could not hook {funcName}")
-			raise RuntimeError(f"Could not hook {funcName}")
-
-	def __del__(self):
-		if self._hook:
-			NVDAHelper.localLib.dllImportTableHooks_unhookSingle(self._hook)
-
-
-_duckersByHandle={}
-
-
-@WINFUNCTYPE(windll.winmm.waveOutOpen.restype,*windll.winmm.waveOutOpen.argtypes,use_errno=False,use_last_error=False)
-def waveOutOpen(pWaveOutHandle,deviceID,wfx,callback,callbackInstance,flags):
-	if audioDucking._isDebug():
-		log.debugWarning("Ducking audio requested for SAPI5 synthdriver")
-	try:
-		res=windll.winmm.waveOutOpen(pWaveOutHandle,deviceID,wfx,callback,callbackInstance,flags) or 0
-	except WindowsError as e:
-		res=e.winerror
-	if res==0 and pWaveOutHandle:
-		h=pWaveOutHandle.contents.value
-		d=audioDucking.AudioDucker()
-		if not d.enable():
-			log.warning("Ducking audio failed for SAPI5 synthdriver")
-		_duckersByHandle[h]=d
-	else:
-		log.warning("Opening wave out failed for SAPI5 synthdriver")
-		log.debugWarning(f"Win Error: {res}\n WaveOutHandle: {pWaveOutHandle}")
-	return res
-
-@WINFUNCTYPE(c_long,c_long)
-def waveOutClose(waveOutHandle):
-	if audioDucking._isDebug():
-		log.debugWarning("End ducking audio requested for SAPI5 synthdriver")
-	try:
-		res=windll.winmm.waveOutClose(waveOutHandle) or 0
-	except WindowsError as e:
-		res=e.winerror
-	if res==0 and waveOutHandle:
-		_duckersByHandle.pop(waveOutHandle,None)
-	else:
-		log.warning("Closing wave out failed for SAPI5 synthdriver")
-		log.debugWarning(f"Res: {res}\n waveOutHandle: {waveOutHandle}")
-	return res
-
-_waveOutHooks=[]
-def ensureWaveOutHooks():
-	if not _waveOutHooks and audioDucking.isAudioDuckingSupported():
-		sapiPath=os.path.join(os.path.expandvars("$SYSTEMROOT"),"system32","speech","common","sapi.dll")
-		_waveOutHooks.append(FunctionHooker(sapiPath,"WINMM.dll","waveOutOpen",waveOutOpen))
-		_waveOutHooks.append(FunctionHooker(sapiPath,"WINMM.dll","waveOutClose",waveOutClose))
-
-
-class SapiSink(object):
+			self._partialFrame = b""
+		width = self._sampleWidth
+		blockSize = self._silenceBlockSize
+		start = 0
+		end = len(data)
+		if audioop.max(data, width) < threshold:
+			# The whole chunk is silent.
+			start = end = min(end, self._leadingSilence)
+			self._leadingSilence -= start
+		else:
+			if self._leadingSilence:
+				limit = min(end, self._leadingSilence)
+				while start < limit and audioop.max(data[start:start + blockSize], width) < threshold:
+					start += blockSize
+				start = min(start, limit)
+				# Trimming stops at the first audible block.
+				self._leadingSilence = 0 if start < limit else self._leadingSilence - start
+			# The skipped blocks are silent, so data[start:] contains audible audio and this loop ends.
+			while audioop.max(data[max(start, end - blockSize):end], width) < threshold:
+				end -= blockSize
+		audible = data[start:end]
+		if audible:
+			toFeed = self._heldSilence + audible
+			self._heldSilence = data[end:]
+		else:
+			toFeed = b""
+			self._heldSilence += data[start:]
+		excess = len(self._heldSilence) - self._maxHeldSilence
+		if excess > 0:
+			# Too much silence to still be trailing, it is a pause within the speech.
+			toFeed += self._heldSilence[:excess]
+			self._heldSilence = self._heldSilence[excess:]
+		return toFeed
+
+	def ISequentialStream_RemoteWrite(self, this, pv, cb: int, pcbWritten) -> int:
+		"""Called when SAPI writes a chunk of audio.
+		@param pv: A pointer to the first byte of the audio data.
+		@param cb: The number of bytes to write.
+		@param pcbWritten: A pointer which receives the number of bytes written, may be null.
+		@return: An HRESULT code.
+		"""
+		synth = self.synthRef()
+		if synth is None:
+			log.debugWarning("Called Write method on SynthDriverAudioStream while driver is dead")
+			return hresult.E_UNEXPECTED
+		if not synth.isSpeaking:
+			# Speech has been cancelled, failing makes SAPI stop producing audio for this stream.
+			self._lastChunk = b""
+			return hresult.E_FAIL
+		data = self._trimSilence(string_at(pv, cb))
+		if data:
+			self.feedLastChunk(synth.player)
+			self._lastChunk = data
+		self._writtenBytes += cb
+		if pcbWritten:
+			pcbWritten[0] = cb
+		return hresult.S_OK
+
+	def IStream_RemoteSeek(self, this, dlibMove: _LARGE_INTEGER, dwOrigin: int, plibNewPosition) -> int:
+		"""Called when SAPI queries the current stream position.
+		Seeking to another position is not supported.
+		@param dlibMove: The offset relative to dwOrigin, only 0 is supported.
+		@param dwOrigin: The origin of the seek, only STREAM_SEEK.CUR is supported.
+		@param plibNewPosition: A pointer to a _ULARGE_INTEGER which receives the position, may be null.
+		@return: An HRESULT code.
+		"""
+		if dwOrigin == STREAM_SEEK.CUR and dlibMove.QuadPart == 0:
+			if plibNewPosition:
+				plibNewPosition[0].QuadPart = self._writtenBytes
+			return hresult.S_OK
+		return hresult.E_NOTIMPL
+
+	def IStream_Commit(self, this, grfCommitFlags: int) -> int:
+		"""Called when SAPI flushes the written data.
+		The audio has already been fed to the player, so there is nothing to do.
+		"""
+		return hresult.S_OK
+
+
+class SapiSink(COMObject):
 	"""Handles SAPI event notifications.
-	See https://msdn.microsoft.com/en-us/library/ms723587(v=vs.85).aspx
+	Implements ISpNotifySink, which is set on the voice with ISpNotifySource::SetNotifySink.
+	Notifications are received on the thread which raised them, rather than being routed through the main thread.
+	This keeps them in order with the audio written to L{SynthDriverAudioStream}.
+	See https://docs.microsoft.com/en-us/previous-versions/windows/desktop/ee450832(v=vs.85)
 	"""
 
-	def __init__(self, synthRef: weakref.ReferenceType):
-		self.synthRef = synthRef
+	_com_interfaces_ = [ISpNotifySink]
+	#: The most events retrieved from SAPI at once.
+	EVENT_BATCH_SIZE = 16
+
+	def __init__(self, synth: "SynthDriver", eventSource: ISpEventSource):
+		super().__init__()
+		#: The driver events are reported for.
+		#: This is a strong reference to avoid dereferencing a weakref for every event,
+		#: so the driver must clear it when it no longer uses this sink (see L{SynthDriver._releaseSink}).
+		self.synth: Optional["SynthDriver"] = synth
+		# The high level GetEvents wrapper only retrieves a single event,
+		# so bind the raw method, which retrieves a batch of events in one call.
+		# This references the voice, which references this sink while it is the voice's notify sink,
+		# so the driver must break this cycle with L{releaseEventSource} when it replaces or releases the voice.
+		self._getEvents = eventSource._ISpEventSource__com_GetEvents
+		self._events = (SPEVENT * self.EVENT_BATCH_SIZE)()
+		self._numFetched = c_ulong()
+
+	def ISpNotifySink_Notify(self):
+		"""Called when there are new events, retrieves and handles all queued events.
+		This is called on SAPI's thread.
+		The extension points notified here are thread safe,
+		and the speech manager queues its handling of them to the main thread.
+		"""
+		getEvents = self._getEvents
+		if self.synth is None or getEvents is None:
+			log.debugWarning("Called Notify method on SapiSink while driver is dead")
+			return
+		while True:
+			getEvents(self.EVENT_BATCH_SIZE, self._events, byref(self._numFetched))
+			numFetched = self._numFetched.value
+			for event in self._events[:numFetched]:
+				self._handleEvent(event)
+			if numFetched < self.EVENT_BATCH_SIZE:
+				break
+
+	def releaseEventSource(self):
+		"""Drops the reference to the voice's event source, once the voice no longer notifies this sink."""
+		self._getEvents = None
+
+	def _handleEvent(self, event: SPEVENT):
+		try:
+			if event.eEventId == SPEventEnum.TTS_BOOKMARK:
+				self.Bookmark(
+					event.ulStreamNum,
+					event.ullAudioStreamOffset,
+					cast(event.lParam, c_wchar_p).value,
+					event.wParam
+				)
+			elif event.eEventId == SPEventEnum.START_INPUT_STREAM:
+				self.StartStream(event.ulStreamNum, event.ullAudioStreamOffset)
+			elif event.eEventId == SPEventEnum.END_INPUT_STREAM:
+				self.EndStream(event.ulStreamNum, event.ullAudioStreamOffset)
+		finally:
+			self._freeEventParam(event)
+
+	@staticmethod
+	def _releaseUnknown(pointer: int):
+		"""Releases a reference to a COM object which is owned by the caller, given as a raw pointer."""
+		# comtypes releases the reference held by a COM pointer when the pointer is destroyed,
+		# which happens as soon as this temporary pointer is discarded.
+		cast(pointer, POINTER(IUnknown))
+
+	@staticmethod
+	def _freeEventParam(event):
+		"""Frees the lParam of an event retrieved with ISpEventSource::GetEvents, as the caller owns it."""
+		if event.elParamType in (SPEventLParamType.TOKEN, SPEventLParamType.OBJECT):
+			SapiSink._releaseUnknown(event.lParam)
+		elif event.elParamType in (SPEventLParamType.POINTER, SPEventLParamType.STRING):
+			windll.ole32.CoTaskMemFree(event.lParam)
 
 	def Bookmark(self, streamNum, pos, bookmark, bookmarkId):
-		synth = self.synthRef()
+		synth = self.synth
 		if synth is None:
 			log.debugWarning("Called Bookmark method on SapiSink while driver is dead")
 			return
-		synthIndexReached.notify(synth=synth, index=bookmarkId)
+		# The bookmark is raised once the audio preceding it has been written, but not yet played.
+		# Therefore, report the index when the player has played the last chunk written before it.
+		synth._audioStream.feedLastChunk(
+			synth.player,
+			# The driver is captured here, as the index may be played after this sink has been released.
+			onDone=lambda index=bookmarkId: self._onIndexReached(synth, index)
+		)
+
+	@staticmethod
+	def _onIndexReached(synth: "SynthDriver", index: int):
+		synth._lastBookmarkId = index
+		synthIndexReached.notify(synth=synth, index=index)
+
+	def StartStream(self, streamNum, pos):
+		synth = self.synth
+		if synth is None:
+			log.debugWarning("Called StartStream method on SapiSink while driver is dead")
+			return
+		synth._audioStream.startStream()
 
 	def EndStream(self, streamNum, pos):
-		synth = self.synthRef()
+		synth = self.synth
 		if synth is None:
 			log.debugWarning("Called Bookmark method on EndStream while driver is dead")
 			return
+		synth._audioStream.endStream()
+		synth._audioStream.feedLastChunk(synth.player)
+		synth.player.idle()
 		synthDoneSpeaking.notify(synth=synth)
 
 
@@ -167,6 +436,8 @@ class SynthDriver(SynthDriver):
 	supportedNotifications = {synthIndexReached, synthDoneSpeaking}
 
 	COM_CLASS = "SAPI.SPVoice"
+	#: The COM class used to wrap L{SynthDriverAudioStream} with its wave format.
+	CUSTOM_STREAM_COM_CLASS = "SAPI.SpCustomStream"
 
 	name="sapi5"
 	description="Microsoft Speech API version 5"
@@ -180,34 +451,53 @@ class SynthDriver(SynthDriver):
 		except:
 			return False
 
-	ttsAudioStream=None #: Holds the ISPAudio interface for the current voice, to aid in stopping and pausing audio
+	#: The voice tokens available to this driver, fetched by index (see L{_cacheVoiceTokens}).
+	_voiceTokens = []
+	#: Maps voice token IDs to the tokens in L{_voiceTokens}.
+	_voiceTokensById = {}
+	#: Receives the events of the current tts object.
+	_sapiSink: Optional[SapiSink] = None
+	#: The flags L{speak} passes with its markup.
+	_speakFlags = SpeechVoiceSpeakFlags.IsXML | SpeechVoiceSpeakFlags.Async
+	#: The flags L{cancel} passes to purge the queued speech.
+	_purgeFlags = SpeechVoiceSpeakFlags.Async | SpeechVoiceSpeakFlags.PurgeBeforeSpeak
 
 	def __init__(self,_defaultVoiceToken=None):
 		"""
 		@param _defaultVoiceToken: an optional sapi voice token which should be used as the default voice (only useful for subclasses)
 		@type _defaultVoiceToken: ISpeechObjectToken
 		"""
-		ensureWaveOutHooks()
 		self._pitch=50
+		#: Plays the audio written by SAPI, (re)created by L{_initAudioOutput} to match the voice's format.
+		self.player: Optional[nvwave.WavePlayer] = None
+		#: Whether audio written by SAPI should be played. Cleared by L{cancel}.
+		self.isSpeaking = False
+		#: The last index which was played, served by L{lastIndex}.
+		self._lastBookmarkId: Optional[int] = None
 		self._initTts(_defaultVoiceToken)
+		self._cacheVoiceTokens()
 
 	def terminate(self):
-		self._eventsConnection = None
+		self.isSpeaking = False
+		if self._sapiSink:
+			self._releaseSink()
 		self.tts = None
+		self._speakMethod = None
+		if self.player:
+			self.player.close()
+			self.player = None
+		self._voiceTokens = []
+		self._voiceTokensById = {}
 
 	def _getAvailableVoices(self):
-		voices=OrderedDict()
-		v=self._getVoiceTokens()
-		# #2629: Iterating uses IEnumVARIANT and GetBestInterface doesn't work on tokens returned by some token enumerators.
-		# Therefore, fetch the items by index, as that method explicitly returns the correct interface.
-		for i in range(len(v)):
+		voices = {}
+		for token in self._voiceTokens:
 			try:
-				ID=v[i].Id
-				name=v[i].GetDescription()
-				try:
-					language=locale.windows_locale[int(v[i].getattribute('language').split(';')[0],16)]
-				except KeyError:
-					language=None
+				ID = token.Id
+				name = token.GetDescription()
+				# Voices may report an LCID which Python doesn't know about.
+				lcid = int(token.getattribute('language').split(';')[0], 16)
+				language = locale.windows_locale.get(lcid)
 			except COMError:
 				log.warning("Could not get the voice info. Skipping...")
 			voices[ID]=VoiceInfo(ID,name,language)
@@ -230,14 +520,14 @@ class SynthDriver(SynthDriver):
 		return self.tts.voice.Id
  
 	def _get_lastIndex(self):
-		bookmark=self.tts.status.LastBookmark
-		if bookmark!="" and bookmark is not None:
-			return int(bookmark)
-		else:
-			return None
+		return self._lastBookmarkId
 
-	def _percentToRate(self, percent):
-		return (percent - 50) // 5
+	#: SAPI rates for each percentage from 0 to 100.
+	_PERCENT_TO_RATE = tuple((percent - 50) // 5 for percent in range(101))
+
+	def _percentToRate(self, percent: int) -> int:
+		# Prosody multipliers can take the percentage out of range.
+		return self._PERCENT_TO_RATE[max(0, min(100, percent))]
 
 	def _set_rate(self,rate):
 		self.tts.Rate = self._percentToRate(rate)
@@ -249,165 +539,242 @@ class SynthDriver(SynthDriver):
 	def _set_volume(self,value):
 		self.tts.Volume = value
 
+	def _releaseSink(self):
+		"""Stops the current tts object notifying L{_sapiSink}.
+		The voice references the sink and the sink references the voice's event source,
+		so this must be done before the tts object is replaced or released, otherwise neither is ever freed.
+		"""
+		self.tts.QueryInterface(ISpNotifySource).SetNotifySink(None)
+		sink = self._sapiSink
+		sink.releaseEventSource()
+		# Break the reference cycle between this driver and the sink.
+		# Indexes it has queued on the player still reach this driver through their callbacks.
+		sink.synth = None
+		self._sapiSink = None
+
 	def _initTts(self, voice=None):
+		if self._sapiSink:
+			self._releaseSink()
 		self.tts=comtypes.client.CreateObject(self.COM_CLASS)
+		# Bound once per tts object, rather than looked up on the COM proxy for every call.
+		self._speakMethod = self.tts.Speak
 		if voice:
 			# #749: It seems that SAPI 5 doesn't reset the audio parameters when the voice is changed,
 			# but only when the audio output is changed.
 			# Therefore, set the voice before setting the audio output.
 			# Otherwise, we will get poor speech quality in some cases.
 			self.tts.voice = voice
-		outputDeviceID=nvwave.outputDeviceNameToID(config.conf["speech"]["outputDevice"], True)
-		if outputDeviceID>=0:
-			self.tts.audioOutput=self.tts.getAudioOutputs()[outputDeviceID]
-		self._eventsConnection = comtypes.client.GetEvents(self.tts, SapiSink(weakref.ref(self)))
-		self.tts.EventInterests = SpeechVoiceEvents.Bookmark | SpeechVoiceEvents.EndInputStream
-		from comInterfaces.SpeechLib import ISpAudio
-		try:
-			self.ttsAudioStream=self.tts.audioOutputStream.QueryInterface(ISpAudio)
-		except COMError:
-			log.debugWarning("SAPI5 voice does not support ISPAudio") 
-			self.ttsAudioStream=None
-
-	def _set_voice(self,value):
+		self._initAudioOutput()
+		self.tts.EventInterests = (
+			SpeechVoiceEvents.StartInputStream | SpeechVoiceEvents.Bookmark | SpeechVoiceEvents.EndInputStream
+		)
+		self._sapiSink = SapiSink(self, self.tts.QueryInterface(ISpEventSource))
+		self.tts.QueryInterface(ISpNotifySource).SetNotifySink(self._sapiSink)
+
+	def _initAudioOutput(self):
+		"""Routes the audio of the current voice through L{player}, rather than SAPI's own audio output.
+		This lets NVDA's audio output handle SAPI5 like the other synths,
+		avoiding the extra latency of SAPI's output device.
+		"""
+		# Use the format SAPI chose for its default audio output with this voice.
+		fmt = self.tts.AudioOutputStream.Format
+		wfx = fmt.GetWaveFormatEx()
+		if wfx.FormatTag != nvwave.WAVE_FORMAT_PCM:
+			log.debugWarning(f"Unsupported SAPI5 wave format {wfx.FormatTag}, using 22 kHz 16 bit mono")
+			fmt.Type = SpeechAudioFormatType.SAFT22kHz16BitMono
+			wfx = fmt.GetWaveFormatEx()
+		if (
+			not self.player
+			or self.player.channels != wfx.Channels
+			or self.player.samplesPerSec != wfx.SamplesPerSec
+			or self.player.bitsPerSample != wfx.BitsPerSample
+		):
+			if self.player:
+				self.player.close()
+			self.player = nvwave.WavePlayer(
+				channels=wfx.Channels,
+				samplesPerSec=wfx.SamplesPerSec,
+				bitsPerSample=wfx.BitsPerSample,
+				outputDevice=config.conf["speech"]["outputDevice"],
+			)
+		self._audioStream = SynthDriverAudioStream(
+			weakref.ref(self),
+			channels=wfx.Channels,
+			samplesPerSec=wfx.SamplesPerSec,
+			bitsPerSample=wfx.BitsPerSample,
+		)
+		customStream = comtypes.client.CreateObject(self.CUSTOM_STREAM_COM_CLASS)
+		customStream.BaseStream = self._audioStream
+		customStream.Format = fmt
+		# The player has been opened with this format, so SAPI must not change it.
+		self.tts.AllowAudioOutputFormatChangesOnNextSet = False
+		self.tts.AudioOutputStream = customStream
+
+	def _cacheVoiceTokens(self):
+		"""Fetches the voice tokens once for the lifetime of the driver,
+		so that voice lookups don't have to cross the COM boundary for every token.
+		Tokens don't depend on the tts object, so they can be set as the voice of the tts objects created later.
+		"""
 		tokens = self._getVoiceTokens()
 		# #2629: Iterating uses IEnumVARIANT and GetBestInterface doesn't work on tokens returned by some token enumerators.
 		# Therefore, fetch the items by index, as that method explicitly returns the correct interface.
-		for i in range(len(tokens)):
-			voice=tokens[i]
-			if value==voice.Id:
-				break
-		else:
+		self._voiceTokens = [tokens[i] for i in range(len(tokens))]
+		self._voiceTokensById = {}
+		for token in self._voiceTokens:
+			try:
+				self._voiceTokensById[token.Id] = token
+			except COMError:
+				log.warning("Could not get the voice token ID. Skipping...")
+
+	def _set_voice(self, value):
+		voice = self._voiceTokensById.get(value)
+		if voice is None:
 			# Voice not found.
 			return
 		self._initTts(voice=voice)
 
-	def _percentToPitch(self, percent):
-		return percent // 2 - 25
+	#: SAPI absolute middle pitches for each percentage from 0 to 100.
+	_PERCENT_TO_PITCH = tuple(percent // 2 - 25 for percent in range(101))
+
+	def _percentToPitch(self, percent: int) -> int:
+		return self._PERCENT_TO_PITCH[max(0, min(100, percent))]
 
 	IPA_TO_SAPI = {
 		u"θ": u"th",
 		u"s": u"s",
 	}
+	#: The IPA primary stress mark, which SAPI expects as "1" after the stressed phoneme.
+	_IPA_STRESS = u"ˈ"
+	#: Matches a run of stress marks and the phoneme following it (if any).
+	_IPA_STRESS_RE = re.compile(u"%s+([^%s]?)" % (_IPA_STRESS, _IPA_STRESS))
+	#: Translates IPA characters to space terminated SAPI phonemes in a single pass.
+	#: Rebuilt for subclasses which override L{IPA_TO_SAPI} (see L{__init_subclass__}).
+	_IPA_TO_SAPI_TRANS = _makeIpaToSapiTrans(IPA_TO_SAPI, _IPA_STRESS)
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		if "IPA_TO_SAPI" in vars(cls):
+			cls._IPA_TO_SAPI_TRANS = _makeIpaToSapiTrans(cls.IPA_TO_SAPI, cls._IPA_STRESS)
+
 	def _convertPhoneme(self, ipa):
 		# We only know about US English phonemes.
 		# Rather than just ignoring unknown phonemes, SAPI throws an exception.
 		# Therefore, don't bother with any other language.
 		if self.tts.voice.GetAttribute("language") != "409":
 			raise LookupError("No data for this language")
-		out = []
-		outAfter = None
-		for ipaChar in ipa:
-			if ipaChar == u"ˈ":
-				outAfter = u"1"
-				continue
-			out.append(self.IPA_TO_SAPI[ipaChar])
-			if outAfter:
-				out.append(outAfter)
-				outAfter = None
-		if outAfter:
-			out.append(outAfter)
-		return u" ".join(out)
+		if not self._IPA_TO_SAPI_TRANS.keys() >= set(map(ord, ipa)):
+			raise LookupError("Unknown character in IPA string: %s" % ipa)
+		if self._IPA_STRESS in ipa:
+			# The stress marker must follow the stressed phoneme, not precede it.
+			ipa = self._IPA_STRESS_RE.sub(r"\1" + self._IPA_STRESS, ipa)
+		return u" ".join(ipa.translate(self._IPA_TO_SAPI_TRANS).split())
+
+	def _speakIndex(self, item: IndexCommand, state: _SpeakState):
+		state.textList.append(f'<Bookmark Mark="{item.index}" />')
+
+	def _speakCharacterMode(self, item: CharacterModeCommand, state: _SpeakState):
+		if item.state:
+			state.openTagFrags[_SPELL_TAG] = "<spell>"
+			state.closeTagFrags[_SPELL_TAG] = "</spell>"
+		else:
+			state.openTagFrags[_SPELL_TAG] = state.closeTagFrags[_SPELL_TAG] = ""
+		state.tagsChanged = True
 
-	def speak(self, speechSequence):
-		textList = []
+	def _speakBreak(self, item: BreakCommand, state: _SpeakState):
+		# MathPlayer scales break times by a float multiplier, but SAPI expects whole milliseconds.
+		state.textList.append(f'<silence msec="{int(item.time)}" />')
 
-		# NVDA SpeechCommands are linear, but XML is hierarchical.
-		# Therefore, we track values for non-empty tags.
-		# When a tag changes, we close all previously opened tags and open new ones.
-		tags = {}
-		# We have to use something mutable here because it needs to be changed by the inner function.
-		tagsChanged = [True]
-		openedTags = []
-		def outputTags():
-			if not tagsChanged[0]:
-				return
-			for tag in reversed(openedTags):
-				textList.append("</%s>" % tag)
-			del openedTags[:]
-			for tag, attrs in tags.items():
-				textList.append("<%s" % tag)
-				for attr, val in attrs.items():
-					textList.append(' %s="%s"' % (attr, val))
-				textList.append(">")
-				openedTags.append(tag)
-			tagsChanged[0] = False
+	def _speakPitch(self, item: PitchCommand, state: _SpeakState):
+		absMiddle = self._percentToPitch(int(state.pitch * item.multiplier))
+		state.openTagFrags[_PITCH_TAG] = f'<pitch absmiddle="{absMiddle}">'
+		state.tagsChanged = True
+
+	def _speakVolume(self, item: VolumeCommand, state: _SpeakState):
+		if item.multiplier == 1:
+			state.openTagFrags[_VOLUME_TAG] = state.closeTagFrags[_VOLUME_TAG] = ""
+		else:
+			state.openTagFrags[_VOLUME_TAG] = f'<volume level="{int(state.volume * item.multiplier)}">'
+			state.closeTagFrags[_VOLUME_TAG] = "</volume>"
+		state.tagsChanged = True
+
+	def _speakRate(self, item: RateCommand, state: _SpeakState):
+		if item.multiplier == 1:
+			state.openTagFrags[_RATE_TAG] = state.closeTagFrags[_RATE_TAG] = ""
+		else:
+			absSpeed = self._percentToRate(int(state.rate * item.multiplier))
+			state.openTagFrags[_RATE_TAG] = f'<rate absspeed="{absSpeed}">'
+			state.closeTagFrags[_RATE_TAG] = "</rate>"
+		state.tagsChanged = True
 
+	def _speakPhoneme(self, item: PhonemeCommand, state: _SpeakState):
+		try:
+			sym = self._convertPhoneme(item.ipa).translate(_XML_ATTR_ESCAPE)
+			state.textList.append(f'<pron sym="{sym}">{_escapeXml(item.text or "")}</pron>')
+		except LookupError:
+			log.debugWarning(f"Couldn't convert character in IPA string: {item.ipa}")
+			if item.text:
+				state.textList.append(_escapeXml(item.text))
+
+	#: Maps the exact type of each supported command to the method which handles it in L{speak}.
+	#: Commands are looked up by their exact type rather than with isinstance,
+	#: so a subclass of a supported command must be registered here explicitly.
+	_COMMAND_HANDLERS = {
+		IndexCommand: _speakIndex,
+		CharacterModeCommand: _speakCharacterMode,
+		BreakCommand: _speakBreak,
+		PitchCommand: _speakPitch,
+		VolumeCommand: _speakVolume,
+		RateCommand: _speakRate,
+		PhonemeCommand: _speakPhoneme,
+	}
+
+	def speak(self, speechSequence):
 		pitch = self._pitch
+		# Fetching rate and volume each require a COM call to the voice,
+		# so they are read once for the whole sequence rather than for every prosody command.
+		state = _SpeakState(pitch, self.rate, self.volume)
 		# Pitch must always be specified in the markup.
-		tags["pitch"] = {"absmiddle": self._percentToPitch(pitch)}
-		rate = self.rate
-		volume = self.volume
+		state.openTagFrags[_PITCH_TAG] = f'<pitch absmiddle="{self._percentToPitch(pitch)}">'
+		state.closeTagFrags[_PITCH_TAG] = "</pitch>"
+		textList = state.textList
+		handlers = self._COMMAND_HANDLERS
 
 		for item in speechSequence:
-			if isinstance(item, str):
-				outputTags()
-				textList.append(item.replace("<", "&lt;"))
-			elif isinstance(item, IndexCommand):
-				textList.append('<Bookmark Mark="%d" />' % item.index)
-			elif isinstance(item, CharacterModeCommand):
-				if item.state:
-					tags["spell"] = {}
-				else:
-					try:
-						del tags["spell"]
-					except KeyError:
-						pass
-				tagsChanged[0] = True
-			elif isinstance(item, BreakCommand):
-				textList.append('<silence msec="%d" />' % item.time)
-			elif isinstance(item, PitchCommand):
-				tags["pitch"] = {"absmiddle": self._percentToPitch(int(pitch * item.multiplier))}
-				tagsChanged[0] = True
-			elif isinstance(item, VolumeCommand):
-				if item.multiplier == 1:
-					try:
-						del tags["volume"]
-					except KeyError:
-						pass
-				else:
-					tags["volume"] = {"level": int(volume * item.multiplier)}
-				tagsChanged[0] = True
-			elif isinstance(item, RateCommand):
-				if item.multiplier == 1:
-					try:
-						del tags["rate"]
-					except KeyError:
-						pass
-				else:
-					tags["rate"] = {"absspeed": self._percentToRate(int(rate * item.multiplier))}
-				tagsChanged[0] = True
-			elif isinstance(item, PhonemeCommand):
-				try:
-					textList.append(u'<pron sym="%s">%s</pron>'
-						% (self._convertPhoneme(item.ipa), item.text or u""))
-				except LookupError:
-					log.debugWarning("Couldn't convert character in IPA string: %s" % item.ipa)
-					if item.text:
-						textList.append(item.text)
-			elif isinstance(item, SpeechCommand):
-				log.debugWarning("Unsupported speech command: %s" % item)
-			else:
-				log.error("Unknown speech: %s" % item)
+			if type(item) is not str:
+				handler = handlers.get(type(item))
+				if handler:
+					handler(self, item, state)
+					continue
+				if not isinstance(item, str):
+					if isinstance(item, SpeechCommand):
+						log.debugWarning(f"Unsupported speech command: {item}")
+					else:
+						log.error(f"Unknown speech: {item}")
+					continue
+				# A str subclass is spoken like any other text below.
+			if state.tagsChanged:
+				textList.append(state.openedTagsClose)
+				textList.append("".join(state.openTagFrags))
+				state.openedTagsClose = "".join(reversed(state.closeTagFrags))
+				state.tagsChanged = False
+			textList.append(_escapeXml(item))
 		# Close any tags that are still open.
-		tags.clear()
-		tagsChanged[0] = True
-		outputTags()
+		textList.append(state.openedTagsClose)
 
 		text = "".join(textList)
-		flags = SpeechVoiceSpeakFlags.IsXML | SpeechVoiceSpeakFlags.Async
-		self.tts.Speak(text, flags)
+		self.isSpeaking = True
+		self._speakMethod(text, self._speakFlags)
 
 	def cancel(self):
 		# SAPI5's default means of stopping speech can sometimes lag at end of speech, especially with Win8 / Win 10 Microsoft Voices.
-		# Therefore  instruct the underlying audio interface to stop first, before interupting and purging any remaining speech.
-		if self.ttsAudioStream:
-			self.ttsAudioStream.setState(SPAudioState.STOP, 0)
-		self.tts.Speak(None, SpeechVoiceSpeakFlags.Async | SpeechVoiceSpeakFlags.PurgeBeforeSpeak)
+		# Therefore stop playing and accepting audio first, before interupting and purging any remaining speech.
+		self.isSpeaking = False
+		self.player.stop()
+		self._audioStream.discardLastChunk()
+		self._speakMethod(None, self._purgeFlags)
 
 	def pause(self, switch: bool):
 		# SAPI5's default means of pausing in most cases is either extremely slow
 		# (e.g. takes more than half a second) or does not work at all.
-		# Therefore instruct the underlying audio interface to pause instead.
-		if self.ttsAudioStream:
-			self.ttsAudioStream.setState(SPAudioState.PAUSE if switch else SPAudioState.RUN, 0)
+		# Therefore pause the audio player instead.
+		self.player.pause(switch)
@@ -0,0 +1,109 @@
+# A part of NonVisual Desktop Access (NVDA)
+# This file is covered by the GNU General Public License.
+# See the file COPYING for more details.
+# Copyright (C) 2021 NV Access Limited
+
+"""Unit tests for the silence trimming of the sapi5 synth driver's audio stream.
+"""
+
+import struct
+import unittest
+import weakref
+
+import config
+from synthDrivers.sapi5 import SynthDriverAudioStream
+
+#: 1000 samples per second, so each ms of 16 bit mono audio is 2 bytes.
+SAMPLES_PER_SEC = 1000
+THRESHOLD = 200
+TRIM_MS = 20
+
+
+def _silence(ms: int) -> bytes:
+	return struct.pack("<h", THRESHOLD // 2) * ms
+
+
+def _audio(ms: int) -> bytes:
+	return struct.pack("<h", THRESHOLD * 5) * ms
+
+
+class _FakeSynth:
+	pass
+
+
+class TestTrimSilence(unittest.TestCase):
+
+	def setUp(self):
+		self._oldThreshold = config.conf["speech"]["silenceTrimThreshold"]
+		self._oldTrimMs = config.conf["speech"]["silenceTrimMs"]
+		config.conf["speech"]["silenceTrimThreshold"] = THRESHOLD
+		config.conf["speech"]["silenceTrimMs"] = TRIM_MS
+		self._synth = _FakeSynth()
+
+	def tearDown(self):
+		config.conf["speech"]["silenceTrimThreshold"] = self._oldThreshold
+		config.conf["speech"]["silenceTrimMs"] = self._oldTrimMs
+
+	def _makeStream(self, bitsPerSample: int = 16) -> SynthDriverAudioStream:
+		stream = SynthDriverAudioStream(
+			weakref.ref(self._synth),
+			channels=1,
+			samplesPerSec=SAMPLES_PER_SEC,
+			bitsPerSample=bitsPerSample,
+		)
+		stream.startStream()
+		return stream
+
+	def test_leadingSilenceTrimmed(self):
+		stream = self._makeStream()
+		self.assertEqual(stream._trimSilence(_silence(10) + _audio(10)), _audio(10))
+
+	def test_leadingSilenceCapped(self):
+		"""Silence beyond silenceTrimMs at the start, e.g. from a break, is still played."""
+		stream = self._makeStream()
+		# After the leading silence, up to silenceTrimMs may be trailing silence, so it is held back.
+		self.assertEqual(stream._trimSilence(_silence(50)), _silence(10))
+		self.assertEqual(stream._trimSilence(_audio(10)), _silence(20) + _audio(10))
+
+	def test_leadingSilenceCappedWithinChunk(self):
+		stream = self._makeStream()
+		self.assertEqual(stream._trimSilence(_silence(50) + _audio(10)), _silence(30) + _audio(10))
+
+	def test_heldSilencePlayedBeforeAudio(self):
+		"""Trailing silence is held back, and played if more audio follows it."""
+		stream = self._makeStream()
+		self.assertEqual(stream._trimSilence(_audio(10) + _silence(10)), _audio(10))
+		self.assertEqual(stream._trimSilence(_silence(5)), b"")
+		self.assertEqual(stream._trimSilence(_audio(5)), _silence(15) + _audio(5))
+
+	def test_silenceBeyondTrimMsPlayed(self):
+		"""Silence longer than silenceTrimMs is a pause within the speech, so only its end is held back."""
+		stream = self._makeStream()
+		self.assertEqual(stream._trimSilence(_audio(10) + _silence(50)), _audio(10) + _silence(30))
+		self.assertEqual(stream._trimSilence(_audio(5)), _silence(20) + _audio(5))
+
+	def test_trailingSilenceDroppedAtEndOfStream(self):
+		stream = self._makeStream()
+		self.assertEqual(stream._trimSilence(_audio(10) + _silence(10)), _audio(10))
+		stream.endStream()
+		stream.startStream()
+		self.assertEqual(stream._trimSilence(_audio(5)), _audio(5))
+
+	def test_oddSizedWrites(self):
+		"""Writes which split samples don't fail, and the audio is trimmed as if written at once."""
+		stream = self._makeStream()
+		data = _silence(50) + _audio(10) + _silence(5) + _audio(3)
+		out = b"".join(stream._trimSilence(data[start:start + 7]) for start in range(0, len(data), 7))
+		self.assertEqual(out, data[TRIM_MS * 2:])
+
+	def test_thresholdZeroPassesThrough(self):
+		config.conf["speech"]["silenceTrimThreshold"] = 0
+		stream = self._makeStream()
+		data = _silence(50) + _audio(10) + _silence(50) + b"\0"
+		self.assertEqual(stream._trimSilence(data), data)
+
+	def test_not16BitPassesThrough(self):
+		"""Only signed 16 bit audio is trimmed."""
+		stream = self._makeStream(bitsPerSample=8)
+		data = b"\x80" * 50 + b"\xff" * 10 + b"\x80" * 50
+		self.assertEqual(stream._trimSilence(data), data)